@@ -1,12 +1,73 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
+import asyncio
+import hashlib
+import json
 import os
-from dotenv import load_dotenv 
+import re
+import datetime
+import threading
+import time
+from dotenv import load_dotenv
 import google.generativeai as genai
+from exact_cache import ExactCache
 from rag_engine import RAGEngine
+from semantic_cache import SemanticCache
 
 load_dotenv()
 
+# Static persona + directives, shared by every /chat call. Kept as a single
+# constant so it can be uploaded once via Gemini context caching instead of
+# being re-sent (and re-billed) with every request.
+PERSONA_AND_DIRECTIVES = """You are Detective Co-AI-Nan, a sharp, observant, and professional Forensic AI Assistant.
+Your goal is to assist the user in their investigation by analyzing evidence and interpreting regulations.
+
+### OPERATIONAL DIRECTIVES:
+1. Persona: Maintain an analytical, professional, and observant detective persona. You can be slightly formal but conversational—like a seasoned investigator briefing a partner.
+2. Conversation: If the user is just talking or asking non-investigative questions, respond naturally but stay in character.
+3. Using Law/Regulations: If the user's question relates to the provided "Relevant Legal Documents," cite the source as: "According to [Source Name]..." Never mention page numbers.
+4. General Analysis: If the user asks a question not covered by the legal documents, use your "Detective Expertise" (general knowledge) to provide a logical analysis.
+5. Handling Uncertainty: If you lack evidence or documents to support a specific claim, state: "The current evidence is insufficient to reach a definitive forensic conclusion on this matter."
+6. Brevity: Keep responses professional and to-the-point. Only elaborate if the user asks for a "Deep Dive" or "Case Analysis."
+"""
+
+# Inline fallback prefix when explicit context caching is unavailable. Must
+# stay byte-for-byte identical across requests (no timestamps, no
+# interpolation) so Gemini's implicit prefix caching still discounts it.
+STATIC_PREFIX = PERSONA_AND_DIRECTIVES + "\n"
+
+# Cheap retrieval gate: greetings and small talk contain none of these, so
+# they skip the embedding RPC and FAISS search entirely.
+LEGAL_TRIGGERS = frozenset({
+    "law", "laws", "legal", "illegal", "regulation", "regulations", "rule",
+    "rules", "statute", "statutes", "section", "act", "license", "permit",
+    "weapon", "weapons", "firearm", "firearms", "machine", "gun", "guns",
+    "rifle", "pistol", "knife", "knives", "ammunition", "penalty",
+    "penalties", "article", "resolution", "convention", "handbook",
+    "crime", "criminal", "offense", "offence", "prohibited", "banned"
+})
+
+# Detection classes that force retrieval even for short questions.
+WEAPON_CLASSES = frozenset({"gun", "guns", "pistol", "rifle", "knife",
+                            "machine gun", "weapon", "firearm"})
+
+# Per-request prompt templates filled via C-level % substitution instead of
+# rebuilding the layout in the handler on every call.
+PROMPT_TMPL = """### FORENSIC EVIDENCE LOG:
+%(evidence)s
+- PRIMARY THREAT: %(primary)s
+
+%(legal)sUser's Question: "%(q)s" """
+
+LEGAL_SECTION_TMPL = """### LEGAL REFERENCE DATA:
+%(rag)s
+- SOURCE CITATIONS: %(cite)s
+
+"""
+
+PROMPT_CACHE_TTL = datetime.timedelta(hours=1)
+PROMPT_CACHE_REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
 app = Flask(__name__)
 CORS(app, resources={
     r"/*": {
@@ -19,17 +80,60 @@ CORS(app, resources={
 # Initialize Gemini AI
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
+chat_model = None
+prompt_cache = None
+
+def create_prompt_cache():
+    """Upload the static persona + directives once via Gemini context caching."""
+    return genai.caching.CachedContent.create(
+        model='models/gemini-2.5-flash',
+        system_instruction=PERSONA_AND_DIRECTIVES,
+        ttl=PROMPT_CACHE_TTL
+    )
+
+def refresh_prompt_cache():
+    """Background loop: recreate the context cache before its TTL runs out."""
+    global chat_model, prompt_cache
+    while True:
+        time.sleep(60)
+        try:
+            expires = prompt_cache.expire_time
+            if expires - datetime.datetime.now(datetime.timezone.utc) < PROMPT_CACHE_REFRESH_MARGIN:
+                prompt_cache = create_prompt_cache()
+                chat_model = genai.GenerativeModel.from_cached_content(cached_content=prompt_cache)
+                print("♻️ Gemini context cache refreshed")
+        except Exception as e:
+            print(f"⚠️ Context cache refresh failed: {e}")
+
 if not GOOGLE_API_KEY:
     print("❌ Error: GOOGLE_API_KEY not found in .env file")
-else: 
-    genai.configure(api_key=GOOGLE_API_KEY)
-    chat_model = genai.GenerativeModel('gemini-2.5-flash')
-    print("✅ Gemini AI initialized successfully")
+else:
+    # gRPC keeps one persistent channel across calls instead of paying
+    # TCP + TLS setup on every generate_content.
+    genai.configure(api_key=GOOGLE_API_KEY, transport='grpc')
+    try:
+        # Gemini requires a minimum of 2048 cached tokens; if the directives
+        # block is below that, creation fails and we fall back to inlining.
+        prompt_cache = create_prompt_cache()
+        chat_model = genai.GenerativeModel.from_cached_content(cached_content=prompt_cache)
+        threading.Thread(target=refresh_prompt_cache, daemon=True).start()
+        print("✅ Gemini AI initialized (context cache active)")
+    except Exception as e:
+        print(f"⚠️ Context caching unavailable ({e}), sending persona inline")
+        prompt_cache = None
+        chat_model = genai.GenerativeModel('gemini-2.5-flash')
+        print("✅ Gemini AI initialized successfully")
 
 # Initialize RAG Engine
 print("\n🔧 Initializing RAG Engine...")
 rag_engine = RAGEngine(documents_folder="rules_documents")
 
+# Semantic cache: skip Gemini entirely for near-duplicate questions
+semantic_cache = SemanticCache(rag_engine.embeddings)
+
+# Exact cache: identical retried/double-clicked POSTs short-circuit in ~1ms
+exact_cache = ExactCache(redis_url=os.getenv('REDIS_URL'))
+
 @app.route('/')
 def home():
     return jsonify({
@@ -41,84 +145,215 @@ def home():
     })
 
 @app.route('/chat', methods=['POST', 'OPTIONS'])
-def chat_with_ai():
+async def chat_with_ai():
     if request.method == 'OPTIONS':
         return '', 200
-        
+
     """Detective AI investigation assistant with RAG"""
     try:
         data = request.get_json()
         user_question = data.get('question', '')
         detections = data.get('detections', [])
-        
+        # SSE streaming is the default; ?stream=0 keeps the old single-JSON
+        # response for clients that don't consume EventSource.
+        stream_enabled = request.args.get('stream', '1') != '0'
+
+        # Kick off both embedding RPCs up front; they run while the evidence
+        # strings are being built instead of serializing behind them.
+        context_str = ",".join(sorted(d.get('class_name', '') for d in detections))
+
+        q_tokens = set(re.findall(r"[a-z]+", user_question.lower()))
+        weapon_detected = any(d.get('class_name', '').lower() in WEAPON_CLASSES
+                              for d in detections)
+        do_rag = weapon_detected or (len(user_question) > 15
+                                     and bool(q_tokens & LEGAL_TRIGGERS))
+
+        async def run_rag():
+            if not do_rag:
+                return []
+            # With detections present, retrieve for the question plus each
+            # class name in one batched embed + one batched FAISS call.
+            class_names = sorted({d.get('class_name', '') for d in detections
+                                  if d.get('class_name')})[:3]
+            if class_names:
+                per_query = await rag_engine.asearch_batch([user_question] + class_names, k=2)
+                merged = []
+                seen = set()
+                for result in (r for query_results in per_query for r in query_results):
+                    ident = (result['source'], result['page'])
+                    if ident not in seen:
+                        seen.add(ident)
+                        merged.append(result)
+                return merged[:3]
+            return await rag_engine.asearch(user_question, k=4)
+
+        rag_task = asyncio.create_task(run_rag())
+        cache_task = asyncio.create_task(
+            asyncio.to_thread(semantic_cache.lookup, user_question, context_str))
+
         log_entries = []
         highest_conf = 0
         primary_obj = "None"
-        
+
         if detections:
+            # Dense detector output repeats classes ("GUN, GUN, GUN, KNIFE");
+            # group per class with a count and its best confidence instead of
+            # one prompt line per box.
+            grouped = {}
             for d in detections:
                 name = d.get('class_name', 'Unknown Object').upper()
                 conf = d.get('confidence', 0)
-                log_entries.append(f"- {name}: {conf}% confidence")
-                
+                count, max_conf = grouped.get(name, (0, 0))
+                grouped[name] = (count + 1, max(max_conf, conf))
+
                 # Track the most certain detection for the summary
                 if conf > highest_conf:
                     highest_conf = conf
                     primary_obj = name
+
+            for name, (count, max_conf) in grouped.items():
+                suffix = f" ×{count}" if count > 1 else ""
+                log_entries.append(f"- {name}{suffix}: {max_conf}% confidence")
         
         evidence_str = "\n".join(log_entries) if log_entries else "No specific objects identified yet"
-        
+
+        # --- SEMANTIC CACHE LOOKUP ---
+        # Near-duplicate questions ("what is a machine gun?" vs "define machine
+        # gun") reuse the previous reply instead of paying full Gemini latency.
+        cache_vec = None
+        try:
+            cache_vec, cached = await cache_task
+            if cached:
+                rag_task.cancel()
+                if stream_enabled:
+                    def cached_stream():
+                        yield f"data: {json.dumps({'delta': cached['reply'], 'rag_used': cached['rag_used'], 'cache_hit': True})}\n\n"
+                        yield "data: [DONE]\n\n"
+                    return Response(cached_stream(), mimetype='text/event-stream')
+                return jsonify({
+                    "reply": cached['reply'],
+                    "rag_used": cached['rag_used'],
+                    "cache_hit": True
+                })
+        except Exception as e:
+            print(f"⚠️ Semantic cache lookup failed: {e}")
+
         # --- RAG SEARCH ---
         rag_context = ""
         source_citation = ""
-        if rag_engine.vectorstore:
-            results = rag_engine.search(user_question, k=2)  
-            if results:
-                sources = set()
-                context_parts = []
-                for result in results:
-                    source = os.path.basename(result['source'])
-                    sources.add(source.replace('.pdf', '').replace('-', ' ').title())
-                    context_parts.append(result['content'])
-                rag_context = "\n\n".join(context_parts)
-                source_citation = ", ".join(sources)
-
-        # Revised System Prompt for better Persona and Conversational Flow
-        prompt = f"""You are Detective Co-AI-Nan, a sharp, observant, and professional Forensic AI Assistant. 
-Your goal is to assist the user in their investigation by analyzing evidence and interpreting regulations.
+        try:
+            results = await rag_task
+        except Exception as e:
+            print(f"⚠️ RAG search failed: {e}")
+            results = []
+        if results:
+            sources = set()
+            context_parts = []
+            for result in results:
+                sources.add(rag_engine.pretty_source.get(
+                    result['source'], os.path.basename(result['source'])))
+                # Cap each chunk: the useful sentence rarely needs more.
+                context_parts.append(result['content'][:600])
+            rag_context = "\n\n".join(context_parts)
+            source_citation = ", ".join(sources)
 
-### FORENSIC EVIDENCE LOG:
-{evidence_str}
-- PRIMARY THREAT: {primary_obj}
-- ANALYSIS TIMESTAMP: 2026-01-19 13:36:08
+        # --- EXACT CACHE LOOKUP ---
+        # Deterministic key over the exact inputs Gemini would see; retries
+        # and debounce duplicates hit here even when the semantic cache missed.
+        exact_key = 'chat:' + hashlib.sha256(
+            f"{user_question}|{context_str}|{rag_context}".encode()).hexdigest()
+        exact_hit = exact_cache.get(exact_key)
+        if exact_hit is not None:
+            if stream_enabled:
+                def exact_stream():
+                    yield f"data: {json.dumps({'delta': exact_hit['reply'], 'rag_used': exact_hit['rag_used'], 'cache_hit': True})}\n\n"
+                    yield "data: [DONE]\n\n"
+                return Response(exact_stream(), mimetype='text/event-stream')
+            return jsonify({
+                "reply": exact_hit['reply'],
+                "rag_used": exact_hit['rag_used'],
+                "cache_hit": True
+            })
 
-### LEGAL REFERENCE DATA:
-{rag_context if rag_context else "No direct legal matches found in current database."}
-- SOURCE CITATIONS: {source_citation if source_citation else "N/A"}
+        # Static text first, every dynamic token strictly after, so Gemini's
+        # prefix caching sees the longest possible common prefix. The persona
+        # and directives live in the context cache (or in STATIC_PREFIX when
+        # caching is unavailable). No timestamps — they break the prefix match.
+        # Omit the legal section entirely when no chunk survives the score
+        # threshold — no point paying tokens for "no matches found".
+        legal_section = ""
+        if rag_context:
+            legal_section = LEGAL_SECTION_TMPL % {"rag": rag_context,
+                                                  "cite": source_citation}
 
-### OPERATIONAL DIRECTIVES:
-1. Persona: Maintain an analytical, professional, and observant detective persona. You can be slightly formal but conversational—like a seasoned investigator briefing a partner.
-2. Conversation: If the user is just talking or asking non-investigative questions, respond naturally but stay in character.
-3. Using Law/Regulations: If the user's question relates to the provided "Relevant Legal Documents," cite the source as: "According to [Source Name]..." Never mention page numbers.
-4. General Analysis: If the user asks a question not covered by the legal documents, use your "Detective Expertise" (general knowledge) to provide a logical analysis.
-5. Handling Uncertainty: If you lack evidence or documents to support a specific claim, state: "The current evidence is insufficient to reach a definitive forensic conclusion on this matter."
-6. Brevity: Keep responses professional and to-the-point. Only elaborate if the user asks for a "Deep Dive" or "Case Analysis."
+        prompt = PROMPT_TMPL % {"evidence": evidence_str, "primary": primary_obj,
+                                "legal": legal_section, "q": user_question}
 
-User's Question: "{user_question}" """
+        if prompt_cache is None:
+            prompt = STATIC_PREFIX + prompt
+
+        rag_used = bool(rag_context)
+
+        if stream_enabled:
+            # Tokens are forwarded as they arrive, so time-to-first-token is
+            # Gemini's, not full generation time.
+            def stream():
+                try:
+                    response = chat_model.generate_content(prompt, stream=True)
+                    parts = []
+                    for chunk in response:
+                        # chunk.text raises ValueError on part-less chunks
+                        # (safety blocks, final stop chunks) — check parts first.
+                        if chunk.parts and chunk.text:
+                            parts.append(chunk.text)
+                            yield f"data: {json.dumps({'delta': chunk.text, 'rag_used': rag_used})}\n\n"
+                    full_reply = "".join(parts)
+                    # Safety-blocked or truncated generations yield little or
+                    # nothing — never persist those as the canonical reply.
+                    if full_reply:
+                        exact_cache.set(exact_key, {'reply': full_reply, 'rag_used': rag_used})
+                        if cache_vec is not None:
+                            try:
+                                semantic_cache.store(cache_vec, user_question, full_reply, rag_used)
+                            except Exception as e:
+                                print(f"⚠️ Semantic cache store failed: {e}")
+                    yield "data: [DONE]\n\n"
+                except Exception as e:
+                    print(f"❌ Gemini error: {e}")
+                    yield f"data: {json.dumps({'error': '⚠️ Investigation AI temporarily unavailable. Please try again.'})}\n\n"
+                    # Clients detect completion by the sentinel; terminate the
+                    # stream on errors too or they hang / auto-reconnect.
+                    yield "data: [DONE]\n\n"
+            return Response(stream(), mimetype='text/event-stream')
 
         response = chat_model.generate_content(prompt)
-        
+
+        # Confirms the prefix/context cache is actually being hit.
+        cached_tokens = getattr(response.usage_metadata, 'cached_content_token_count', 0)
+        if cached_tokens:
+            print(f"💾 Prompt cache hit: {cached_tokens} tokens discounted")
+
+        exact_cache.set(exact_key, {'reply': response.text, 'rag_used': rag_used})
+
+        if cache_vec is not None:
+            try:
+                semantic_cache.store(cache_vec, user_question, response.text, rag_used)
+            except Exception as e:
+                print(f"⚠️ Semantic cache store failed: {e}")
+
         return jsonify({
             "reply": response.text,
-            "rag_used": bool(rag_context)
+            "rag_used": rag_used,
+            "cache_hit": False
         })
 
     except Exception as e:
         print(f"❌ Gemini error: {e}")
         return jsonify({"reply": "⚠️ Investigation AI temporarily unavailable. Please try again."}), 500
     
-if __name__ == '__main__':
+if __name__ == '__main__' and os.getenv('DEV'):
+    # Single-threaded dev server only; production runs gunicorn (see wsgi.py).
     print("\n" + "="*50)
-    print("🚀 Starting Detective AI Chatbot Service")
+    print("🚀 Starting Detective AI Chatbot Service (dev server)")
     print("="*50)
     app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
@@ -0,0 +1,58 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+class ExactCache:
+    """Exact-match reply cache for identical retried/debounced requests.
+
+    Uses Redis when REDIS_URL is set (shared across gunicorn workers);
+    otherwise falls back to a small in-process TTL dict so dev and tests
+    need no extra infrastructure.
+    """
+
+    def __init__(self, redis_url: Optional[str] = None, ttl_seconds: int = 600,
+                 max_local_entries: int = 1024):
+        self.ttl_seconds = ttl_seconds
+        self.max_local_entries = max_local_entries
+        self._local: OrderedDict = OrderedDict()
+        # Insert/popitem on the fallback dict aren't safe under gunicorn's
+        # threaded workers; Redis does its own synchronization.
+        self._local_lock = threading.Lock()
+        self._redis = None
+        if redis_url:
+            try:
+                import redis
+                self._redis = redis.Redis.from_url(redis_url, decode_responses=True)
+                self._redis.ping()
+                print("✅ Redis exact cache connected")
+            except Exception as e:
+                print(f"⚠️ Redis unavailable ({e}), using in-process exact cache")
+                self._redis = None
+
+    def get(self, key: str) -> Optional[Dict]:
+        if self._redis is not None:
+            try:
+                cached = self._redis.get(key)
+                return json.loads(cached) if cached else None
+            except Exception as e:
+                print(f"⚠️ Redis get failed: {e}")
+                return None
+        with self._local_lock:
+            entry = self._local.get(key)
+            if entry and time.time() - entry[1] < self.ttl_seconds:
+                return entry[0]
+        return None
+
+    def set(self, key: str, payload: Dict):
+        if self._redis is not None:
+            try:
+                self._redis.setex(key, self.ttl_seconds, json.dumps(payload))
+            except Exception as e:
+                print(f"⚠️ Redis set failed: {e}")
+            return
+        with self._local_lock:
+            self._local[key] = (payload, time.time())
+            while len(self._local) > self.max_local_entries:
+                self._local.popitem(last=False)
@@ -1,41 +1,114 @@
+import hashlib
 import os
-import time  
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
-from langchain_google_genai import GoogleGenerativeAIEmbeddings
+
+# The langchain/faiss/numpy stack is deliberately imported inside the methods
+# that need it: importing this module stays cheap (fast cold starts and dev
+# autoreload), and repeat imports just hit sys.modules.
+
+# Pipeline settings. All of these participate in the persisted-index cache key
+# so changing any of them forces a rebuild instead of silently loading a stale
+# index; bump INDEX_CONFIG whenever _build_index parameters change.
+EMBEDDING_MODEL = "models/text-embedding-004"
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 100
+INDEX_CONFIG = "hnsw-m32-ef200|ivfpq-m48-nb8-np16@10k"
 
 class RAGEngine:
     def __init__(self, documents_folder="rules_documents"):
         self.documents_folder = documents_folder
         self.vectorstore = None
-        self.embeddings = GoogleGenerativeAIEmbeddings(model="models/text-embedding-004")
+        self._embeddings = None
+        # LRU memo of recent query results: repeat questions skip the
+        # embedding RPC and the FAISS search entirely.
+        self._query_cache: OrderedDict = OrderedDict()
+        self._query_cache_max = 1024
+        # move_to_end/popitem aren't safe under gunicorn's threaded workers.
+        self._query_cache_lock = threading.Lock()
+        # Sliding-window rate limiter for embedding calls: stay just under
+        # the documented 1500 requests/minute without blind sleeps.
+        self._req_ts: deque = deque()
+        self._req_limit = 1400
+        self._req_window = 60
         
         if not os.path.exists(documents_folder):
             os.makedirs(documents_folder)
             print(f"✅ Created folder: {documents_folder}")
-        
+
+        # Pretty display names per source path, computed once instead of
+        # re-deriving them from the filename on every request.
+        self.pretty_source = {
+            os.path.join(documents_folder, name):
+                name.replace('.pdf', '').replace('-', ' ').title()
+            for name in os.listdir(documents_folder)
+        }
+
         self.load_documents()
-    
+
+    @property
+    def embeddings(self):
+        """Single shared instance over a persistent gRPC channel, built lazily."""
+        if self._embeddings is None:
+            from langchain_google_genai import GoogleGenerativeAIEmbeddings
+            self._embeddings = GoogleGenerativeAIEmbeddings(model=EMBEDDING_MODEL,
+                                                            transport="grpc")
+        return self._embeddings
+
+    def _cache_dir(self) -> str:
+        """Index cache path keyed by the documents folder plus pipeline config."""
+        config = f"{EMBEDDING_MODEL}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{INDEX_CONFIG}"
+        parts = sorted(f"{name}:{os.path.getmtime(os.path.join(self.documents_folder, name))}"
+                       for name in os.listdir(self.documents_folder))
+        key = hashlib.sha256("|".join([config] + parts).encode()).hexdigest()[:16]
+        return os.path.join(".faiss_cache", key)
+
     def load_documents(self):
+        from langchain_community.vectorstores import FAISS
+
+        # Warm start: reuse the persisted index if the folder hasn't changed,
+        # skipping PDF parsing and all embedding calls entirely.
+        cache_dir = self._cache_dir()
+        if os.path.exists(cache_dir):
+            self.vectorstore = FAISS.load_local(cache_dir, self.embeddings,
+                                                allow_dangerous_deserialization=True)
+            print(f"⚡ Loaded FAISS index from cache: {cache_dir}")
+            return
+
         print(f"📂 Loading documents from: {self.documents_folder}")
+        import numpy as np
+        from langchain_community.docstore.in_memory import InMemoryDocstore
+        from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+
         all_documents = []
         file_count = 0
         loaders = {'.pdf': PyPDFLoader, '.txt': TextLoader, '.docx': Docx2txtLoader}
         
-        for filename in os.listdir(self.documents_folder):
-            file_path = os.path.join(self.documents_folder, filename)
-            file_ext = os.path.splitext(filename)[1].lower()
-            if file_ext in loaders:
-                try:
-                    loader = loaders[file_ext](file_path)
-                    documents = loader.load()
-                    all_documents.extend(documents)
-                    file_count += 1
-                    print(f"   ✅ Loaded: {filename} ({len(documents)} pages)")
-                except Exception as e:
-                    print(f"   ❌ Error loading {filename}: {e}")
+        jobs = [(filename, os.path.splitext(filename)[1].lower())
+                for filename in os.listdir(self.documents_folder)
+                if os.path.splitext(filename)[1].lower() in loaders]
+
+        def _load(job):
+            filename, file_ext = job
+            try:
+                documents = loaders[file_ext](os.path.join(self.documents_folder, filename)).load()
+                print(f"   ✅ Loaded: {filename} ({len(documents)} pages)")
+                return documents
+            except Exception as e:
+                print(f"   ❌ Error loading {filename}: {e}")
+                return None
+
+        # Each parse is independent I/O + CPU work, so load files concurrently.
+        if jobs:
+            with ThreadPoolExecutor(max_workers=min(8, len(jobs))) as executor:
+                for documents in executor.map(_load, jobs):
+                    if documents is not None:
+                        all_documents.extend(documents)
+                        file_count += 1
         
         if file_count == 0:
             print("⚠️ No documents found.")
@@ -43,55 +116,184 @@ class RAGEngine:
         
         # Split documents into chunks
         text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=5000,
-            chunk_overlap=300,
-            length_function=len
+            chunk_size=CHUNK_SIZE,
+            chunk_overlap=CHUNK_OVERLAP,
+            length_function=len,
+            separators=["\n\n", "\n", ". ", " ", ""]
         )
         chunks = text_splitter.split_documents(all_documents)
         print(f"📝 Created {len(chunks)} chunks")
         
-        # --- NEW BATCHING LOGIC TO PREVENT 429 ERRORS ---
-        print("🔍 Creating vector embeddings in batches (Respecting Quota)...")
-        batch_size = 50  # Process 50 chunks at a time
-        self.vectorstore = None
+        # --- BATCH EMBEDDING ---
+        # One embed_documents call per large batch instead of per-chunk RPCs,
+        # then a single FAISS build from the precomputed vectors.
+        print("🔍 Creating vector embeddings (batched)...")
+        texts = [c.page_content for c in chunks]
+        vectors = self._embed_with_retry(texts)
 
-        for i in range(0, len(chunks), batch_size):
-            batch = chunks[i : i + batch_size]
-            try:
-                if self.vectorstore is None:
-                    self.vectorstore = FAISS.from_documents(batch, self.embeddings)
-                else:
-                    self.vectorstore.add_documents(batch)
-                
-                print(f"   ✅ Processed chunks {i} to {min(i + batch_size, len(chunks))}")
-                
-                # Sleep to avoid hitting the 1,500 Requests Per Minute limit
-                if i + batch_size < len(chunks):
-                    time.sleep(2) 
-                    
-            except Exception as e:
-                print(f"   ❌ API Limit Hit: {e}")
-                print("   ⏳ Waiting 10 seconds before retrying batch...")
-                time.sleep(10)
-                # Retry logic for the failed batch
-                if self.vectorstore is None:
-                    self.vectorstore = FAISS.from_documents(batch, self.embeddings)
-                else:
-                    self.vectorstore.add_documents(batch)
+        vecs = np.array(vectors, dtype='f4')
+        index = self._build_index(vecs)
+        self.vectorstore = FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore({str(i): c for i, c in enumerate(chunks)}),
+            index_to_docstore_id={i: str(i) for i in range(len(chunks))}
+        )
+
+        self.vectorstore.save_local(cache_dir)
+        print(f"💾 Saved FAISS index to cache: {cache_dir}")
 
         print(f"✅ RAG Engine ready! Loaded {file_count} documents.")
 
-    def search(self, query: str, k: int = 3) -> List[Dict]:
-        if not self.vectorstore: return []
-        results = self.vectorstore.similarity_search_with_score(query, k=k)
+    def _build_index(self, vecs):
+        """Pick an index for the corpus size.
+
+        Small corpora get HNSW (~O(log N) search instead of a full scan).
+        Past ~10k vectors, raw FP32 scans become memory-bandwidth-bound, so
+        we switch to IVF with 8-bit product quantization: ~30x less memory
+        per vector and proportionally fewer bytes touched per query, at a
+        small recall cost (MMR's fetch_k oversampling absorbs most of it).
+        """
+        import faiss
+
+        dim = vecs.shape[1]
+        if len(vecs) >= 10000:
+            nlist = min(256, len(vecs) // 40 or 1)
+            quantizer = faiss.IndexFlatL2(dim)
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, 48, 8)
+            index.train(vecs)
+            index.add(vecs)
+            index.nprobe = 16
+            # MMR retrieval calls index.reconstruct() on fetched candidates;
+            # IVF indexes raise "direct map not initialized" without this.
+            index.make_direct_map()
+        else:
+            index = faiss.IndexHNSWFlat(dim, 32)
+            index.hnsw.efConstruction = 200
+            index.hnsw.efSearch = 64
+            index.add(vecs)
+        return index
+
+    def _throttle(self, n_requests: int):
+        """Block only as long as needed to keep n_requests under quota."""
+        now = time.time()
+        while self._req_ts and now - self._req_ts[0] > self._req_window:
+            self._req_ts.popleft()
+        if len(self._req_ts) + n_requests > self._req_limit:
+            wait = self._req_window - (now - self._req_ts[0])
+            if wait > 0:
+                print(f"   ⏳ Rate limit window full, waiting {wait:.1f}s...")
+                time.sleep(wait)
+
+    def _embed_with_retry(self, texts: List[str], batch_size: int = 100) -> List[List[float]]:
+        """Embed texts in large batches with exponential backoff on 429s."""
+        vectors = []
+        for i in range(0, len(texts), batch_size):
+            batch = texts[i : i + batch_size]
+            delay = 10
+            for attempt in range(4):
+                try:
+                    self._throttle(len(batch))
+                    vectors.extend(self.embeddings.embed_documents(batch))
+                    self._req_ts.extend(time.time() for _ in batch)
+                    break
+                except Exception as e:
+                    if attempt == 3:
+                        raise
+                    print(f"   ❌ API Limit Hit: {e}")
+                    print(f"   ⏳ Waiting {delay} seconds before retrying batch...")
+                    time.sleep(delay)
+                    delay *= 2
+            print(f"   ✅ Embedded chunks {i} to {min(i + batch_size, len(texts))}")
+        return vectors
+
+    def _format_results(self, results) -> List[Dict]:
         return [{'content': doc.page_content, 'source': doc.metadata.get('source', 'Unknown'),
                  'page': doc.metadata.get('page', 'N/A'), 'score': float(score)} for doc, score in results]
 
+    def _search_by_vector(self, embedding, k: int, use_mmr: bool,
+                          score_threshold: float) -> List[Dict]:
+        if use_mmr:
+            results = self.vectorstore.max_marginal_relevance_search_with_score_by_vector(
+                embedding, k=k, fetch_k=4 * k, lambda_mult=0.5)
+        else:
+            results = self.vectorstore.similarity_search_with_score_by_vector(embedding, k=k)
+        # FAISS scores are L2 distances (lower = closer); drop far-off chunks
+        # so irrelevant filler never reaches the prompt.
+        return self._format_results([r for r in results if r[1] <= score_threshold])
+
+    def _cache_get(self, key):
+        with self._query_cache_lock:
+            if key in self._query_cache:
+                self._query_cache.move_to_end(key)
+                return self._query_cache[key]
+        return None
+
+    def _cache_put(self, key, results: List[Dict]):
+        with self._query_cache_lock:
+            self._query_cache[key] = results
+            if len(self._query_cache) > self._query_cache_max:
+                self._query_cache.popitem(last=False)
+
+    def search(self, query: str, k: int = 3, use_mmr: bool = True,
+               score_threshold: float = 0.8) -> List[Dict]:
+        if not self.vectorstore: return []
+        key = (query.strip().lower(), k, use_mmr, score_threshold)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        embedding = self.embeddings.embed_query(query)
+        results = self._search_by_vector(embedding, k, use_mmr, score_threshold)
+        self._cache_put(key, results)
+        return results
+
+    async def asearch(self, query: str, k: int = 3, use_mmr: bool = True,
+                      score_threshold: float = 0.8) -> List[Dict]:
+        """Async search: awaits the embedding RPC instead of blocking on it."""
+        if not self.vectorstore: return []
+        key = (query.strip().lower(), k, use_mmr, score_threshold)
+        cached = self._cache_get(key)
+        if cached is not None:
+            return cached
+        embedding = await self.embeddings.aembed_query(query)
+        results = self._search_by_vector(embedding, k, use_mmr, score_threshold)
+        self._cache_put(key, results)
+        return results
+
+    def _batch_results(self, vecs, k: int,
+                       score_threshold: float) -> List[List[Dict]]:
+        D, I = self.vectorstore.index.search(vecs, k)
+        all_results = []
+        for row_d, row_i in zip(D, I):
+            pairs = []
+            for dist, idx in zip(row_d, row_i):
+                if idx == -1 or dist > score_threshold:
+                    continue
+                doc_id = self.vectorstore.index_to_docstore_id[idx]
+                pairs.append((self.vectorstore.docstore.search(doc_id), dist))
+            all_results.append(self._format_results(pairs))
+        return all_results
+
+    def search_batch(self, queries: List[str], k: int = 2,
+                     score_threshold: float = 0.8) -> List[List[Dict]]:
+        """Search several sub-queries with one embedding RPC and one FAISS call."""
+        import numpy as np
+        if not self.vectorstore or not queries: return [[] for _ in queries]
+        vecs = np.array(self.embeddings.embed_documents(queries), dtype='f4')
+        return self._batch_results(vecs, k, score_threshold)
+
+    async def asearch_batch(self, queries: List[str], k: int = 2,
+                            score_threshold: float = 0.8) -> List[List[Dict]]:
+        import numpy as np
+        if not self.vectorstore or not queries: return [[] for _ in queries]
+        vecs = np.array(await self.embeddings.aembed_documents(queries), dtype='f4')
+        return self._batch_results(vecs, k, score_threshold)
+
     def get_context_for_question(self, question: str, max_chunks: int = 3) -> str:
         if not self.vectorstore: return "No rule documents loaded."
         results = self.search(question, k=max_chunks)
         if not results: return "No relevant information found."
-        return "\n".join([f"[Source {i}: {os.path.basename(r['source'])}, Page {r['page']}]\n{r['content']}\n" 
+        return "\n".join([f"[Source {i}: {self.pretty_source.get(r['source'], os.path.basename(r['source']))}, Page {r['page']}]\n{r['content']}\n"
                           for i, r in enumerate(results, 1)])
 
 if __name__ == "__main__":
@@ -0,0 +1,73 @@
+import threading
+import time
+from typing import List, Dict, Tuple
+
+# faiss/numpy are imported inside the methods that need them, matching
+# rag_engine.py: importing this module at app startup stays cheap.
+
+class SemanticCache:
+    """Reuses Gemini replies for semantically duplicate questions.
+
+    Keeps an inner-product FAISS index over L2-normalized question embeddings
+    plus a parallel list of cached replies. A lookup that scores above the
+    similarity threshold (cosine, since vectors are normalized) returns the
+    stored reply without touching Gemini.
+    """
+
+    def __init__(self, embeddings, similarity_threshold: float = 0.92,
+                 ttl_seconds: int = 3600, max_entries: int = 5000):
+        self.embeddings = embeddings
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.index = None  # faiss.IndexFlatIP, created lazily on first store
+        self.entries: List[Dict] = []
+        # Guards index + entries: gunicorn gthread workers call lookup/store
+        # concurrently, and eviction swaps both structures.
+        self._lock = threading.Lock()
+
+    def embed(self, question: str, context_str: str):
+        """Embed question + detection context as a normalized float32 vector."""
+        import numpy as np
+        vec = np.array(self.embeddings.embed_query(f"{question}|{context_str}"), dtype='f4')
+        norm = np.linalg.norm(vec)
+        if norm > 0:
+            vec /= norm
+        return vec
+
+    def lookup(self, question: str, context_str: str) -> Tuple:
+        """Return (query_vector, cached_entry). Entry is None on a miss.
+
+        The vector is returned so a subsequent store() doesn't pay for a
+        second embedding call.
+        """
+        vec = self.embed(question, context_str)  # RPC stays outside the lock
+        with self._lock:
+            if self.index is None or self.index.ntotal == 0:
+                return vec, None
+            D, I = self.index.search(vec[None, :], 1)
+            if D[0, 0] >= self.similarity_threshold:
+                entry = self.entries[I[0, 0]]
+                if time.time() - entry['ts'] < self.ttl_seconds:
+                    return vec, entry
+        return vec, None
+
+    def store(self, vec, question: str, reply: str, rag_used: bool):
+        import faiss
+        import numpy as np
+        with self._lock:
+            if self.index is None:
+                self.index = faiss.IndexFlatIP(vec.shape[0])
+            self.entries.append({'question': question, 'reply': reply,
+                                 'ts': time.time(), 'rag_used': rag_used})
+            self.index.add(vec[None, :])
+
+            # FIFO eviction: drop the oldest entries and rebuild the flat index
+            # (cheap at this size) whenever we exceed the cap.
+            if len(self.entries) > self.max_entries:
+                keep = self.max_entries // 2
+                self.entries = self.entries[-keep:]
+                vectors = np.vstack([self.index.reconstruct(i)
+                                     for i in range(self.index.ntotal - keep, self.index.ntotal)])
+                self.index = faiss.IndexFlatIP(vec.shape[0])
+                self.index.add(vectors)
@@ -0,0 +1,12 @@
+"""Production entrypoint for the Detective AI chatbot service.
+
+Run with:
+    gunicorn -k gthread -w 2 --threads 32 --timeout 60 -b 0.0.0.0:5001 wsgi:app
+
+gthread lets dozens of /chat requests sit waiting on Gemini concurrently
+per worker. The async /chat view runs its own event loop per request via
+Flask's async support, so no gevent monkey-patching is needed (patching
+would conflict with asyncio); rag_engine and chat_model are plain network
+clients with lazy connections and are safe under threaded workers.
+"""
+from app import app  # noqa: F401